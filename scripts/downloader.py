@@ -1,4 +1,6 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import sys
 import json
@@ -6,17 +8,39 @@ import re
 import time
 import random
 import gzip
+import hashlib
+import functools
 import shutil
 import urllib.robotparser
 import logging
 import signal
-import socket
-from urllib.parse import urljoin, urlparse
-from collections import deque
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import io
+import mmap
+from array import array
+from urllib.parse import urljoin, urlparse, urlsplit
+from collections import Counter, deque
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from dataclasses import dataclass
 from datetime import datetime
 from email.utils import parsedate_to_datetime
 
+try:
+    from lxml import etree
+except ImportError:  # Sin lxml se usa el escaneo por regex
+    etree = None
+
+try:
+    import orjson
+except ImportError:  # Sin orjson se usa json de la stdlib
+    orjson = None
+
+try:
+    from isal import igzip
+except ImportError:  # Sin python-isal se usa gzip (zlib) de la stdlib
+    igzip = None
+
 # --- Configuration ---
 SITES_FILE = os.getenv("SITES_FILE", "sites.txt")
 DATA_DIR = "sitemaps_data" 
@@ -32,20 +56,67 @@ USER_AGENTS = [
 ]
 
 MAX_WORKERS = 5 
+MAX_SITE_WORKERS = 8  # Dominios rastreados en paralelo (concurrencia total = dominios * MAX_WORKERS)
 TIME_LIMIT_SECONDS = 340 * 60 # 5.6 hours (GHA limit is 6h)
 MIN_DISK_FREE_BYTES = 512 * 1024 * 1024 
 MAX_FILES_PER_RUN = 500
 TIMEOUT = 25
+WRITE_QUEUE_SIZE = 256  # Archivos pendientes de escribir por dominio antes de frenar a los workers
+JOURNAL_COMPACT_EVERY = 200  # Entradas de journal tras las que se reescribe el snapshot a mitad de dominio
+GLOBAL_SAVE_INTERVAL = 60  # Segundos mínimos entre escrituras de global_state.json al cerrar dominios
 
 # Efficiency & Politeness
 MAX_URL_RETRIES = 3 
 DOMAIN_FAILURE_LIMIT = 25 
 DEFAULT_CRAWL_DELAY = 2.0  # Aumentado para ser más respetuoso
+ROBOTS_CACHE_TTL = 6 * 3600  # robots.txt se reutiliza sin petición durante este tiempo (el workflow corre cada hora)
+ROBOTS_FAILURE_TTL = 3600  # Tras un fallo transitorio (5xx, 429, red) se reintenta antes
+DELAY_RECOVERY_STREAK = 10  # Éxitos seguidos tras los que se relaja un retraso subido por 403/429
+DELAY_RECOVERY_STEP = 0.5  # Segundos que se restan en cada relajación (nunca por debajo del de robots.txt)
+
+_SAFE_TRANS = str.maketrans({".": "_", "/": "_"})  # Nombre de carpeta seguro para un dominio
+
+SUBFOLDERS = ("indices", "content_rich", "content_raw")
+
+GZIP_MAGIC = b"\x1f\x8b"  # Sitemaps servidos ya comprimidos (.xml.gz) sin Content-Encoding
+GZIP_LEVEL = 6  # gzip.compress usa 9 por defecto: bastante más lento y apenas comprime más el XML
 
 COMMON_PATHS = ["/sitemap.xml", "/sitemap_index.xml", "/sitemap-index.xml", "/sitemap.php", "/sitemap.xml.gz"]
 
 START_TIME = time.time()
 FILES_PROCESSED_THIS_RUN = 0
+STOP_EVENT = threading.Event()  # Activado por SIGINT/SIGTERM para cerrar los dominios en curso
+LAST_GLOBAL_SAVE = 0.0
+_MKDIR_CACHE = set()
+_MKDIR_LOCK = threading.Lock()
+
+# --- HTTP Session ---
+# Sesión compartida: keep-alive y pool de conexiones entre todas las descargas del mismo host.
+# Los códigos 429/403 se siguen gestionando en get_with_retry, por eso raise_on_status=False.
+SESSION = requests.Session()
+# Cabeceras fijas una sola vez; cada petición solo añade User-Agent y las condicionales
+SESSION.headers.update({
+    "User-Agent": USER_AGENTS[0],
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Accept-Encoding": "gzip, deflate",
+    "DNT": "1",
+    "Upgrade-Insecure-Requests": "1"
+})
+# pool_connections es el número de hosts con pool vivo: con varios dominios en paralelo
+# (y sus redirecciones a www.) el valor por defecto desalojaba pools aún en uso.
+# 429 no se reintenta aquí: lo gestiona get_with_retry, que respeta Retry-After y avisa al AIMD.
+# respect_retry_after_header=False porque urllib3 reintentaría igualmente un 429 con Retry-After.
+# connect=0 y read=False (sin reintento y con la excepción original, como requests por defecto):
+# los fallos de red y timeouts ya los reintenta get_with_retry; aquí solo se reintentan los 5xx
+_ADAPTER = HTTPAdapter(
+    pool_connections=MAX_SITE_WORKERS * 2,
+    pool_maxsize=MAX_WORKERS * 2,
+    max_retries=Retry(total=2, connect=0, read=False, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504],
+                      respect_retry_after_header=False, raise_on_status=False)
+)
+SESSION.mount("https://", _ADAPTER)
+SESSION.mount("http://", _ADAPTER)
 
 # --- Logging Setup ---
 sys.stdout.reconfigure(line_buffering=True)
@@ -57,9 +128,17 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- Regex ---
-RE_LOC = re.compile(r'<loc>(.*?)</loc>', re.IGNORECASE)
-RE_SITEMAP_INDEX = re.compile(r'<sitemapindex', re.IGNORECASE)
-RE_RICH_METADATA = re.compile(r'(image:caption|image:title|news:title|video:title|video:description|<title>)', re.IGNORECASE)
+# [ \t]* y no \s*: una directiva vacía no debe tomar como valor la línea siguiente
+RE_ROBOTS_SITEMAP = re.compile(rb'(?mi)^[ \t]*sitemap[ \t]*:[ \t]*(\S+)')
+RE_ROBOTS_CRAWL_DELAY = re.compile(rb'(?mi)^[ \t]*crawl-delay[ \t]*:[ \t]*(\S+)')
+# Índice, <loc> y metadatos ricos en una sola pasada; se despacha por m.lastgroup
+RE_SITEMAP_SCAN = re.compile(
+    rb'(?P<idx><sitemapindex)|<loc>(?P<loc>.*?)</loc>|(?P<rich>image:caption|image:title|news:title|video:title|video:description|<title>)',
+    re.IGNORECASE
+)
+
+# Equivalentes (prefijo, nombre local) de los metadatos ricos para el parser XML
+RICH_TAGS = {("image", "caption"), ("image", "title"), ("news", "title"), ("video", "title"), ("video", "description"), (None, "title")}
 
 def get_elapsed_time():
     return time.time() - START_TIME
@@ -71,15 +150,88 @@ def check_disk_space():
     except:
         return True
 
+def json_dumps(data, sort_keys=False):
+    """Serializa a bytes compactos (orjson si está disponible)"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS if sort_keys else None)
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False, sort_keys=sort_keys).encode()
+
+def json_loads(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def read_json_file(path):
+    """Carga un JSON de disco; con orjson se parsea sobre un mmap, sin copiar el archivo a bytes"""
+    with open(path, 'rb') as f:
+        if orjson is not None and os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                return orjson.loads(view)
+        return json_loads(f.read())
+
 def atomic_write_json(filepath, data):
     try:
         temp_path = filepath + ".tmp"
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(temp_path, 'w') as f:
-            json.dump(data, f, indent=2)
+        # Claves ordenadas: el orden de llegada de las descargas no cambia el snapshot
+        # y la rama de datos solo ve diffs reales
+        with open(temp_path, 'wb') as f:
+            f.write(json_dumps(data, sort_keys=True))
         os.replace(temp_path, filepath)
+        return True
     except Exception as e:
         logger.error(f"Failed to save state to {filepath}: {e}")
+        return False
+
+def ensure_dir(path):
+    """os.makedirs solo la primera vez que se ve cada carpeta en esta ejecución"""
+    if path in _MKDIR_CACHE:
+        return
+    with _MKDIR_LOCK:
+        if path not in _MKDIR_CACHE:
+            os.makedirs(path, exist_ok=True)
+            _MKDIR_CACHE.add(path)
+
+def gzip_compress(data):
+    """Siempre zlib a GZIP_LEVEL: ISA-L comprime más rápido pero sus niveles (0-3) dejan archivos
+    bastante mayores, y estos se suben a la rama de datos. mtime=0 para salida reproducible."""
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+def gzip_decompress(data):
+    """ISA-L (SIMD) si está disponible: descomprimir no afecta al tamaño de lo guardado"""
+    if igzip is not None:
+        return igzip.decompress(data)
+    return gzip.decompress(data)
+
+def write_file(path, data):
+    """Escribe el archivo completo con os.open/os.write, sin la capa de objetos file"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def file_writer(write_q, written_q):
+    """Hilo escritor: saca (path, data, url) de la cola para que los workers HTTP no esperen al disco.
+    Cada escritura terminada se confirma en `written_q` como (url, error o None) antes del task_done,
+    así que tras write_q.join() todas las confirmaciones ya están en `written_q`."""
+    while True:
+        item = write_q.get()
+        try:
+            if item is None:
+                return
+            path, data, url = item
+            error = None
+            try:
+                write_file(path, data)
+            except Exception as e:
+                logger.error(f"Failed to write {path}: {e}")
+                error = str(e)
+            written_q.put((url, error))
+        finally:
+            write_q.task_done()
 
 # --- STATE & STATS MANAGEMENT ---
 
@@ -94,38 +246,170 @@ def load_global_state():
     state = {"domain_stats": {}}
     if os.path.exists(GLOBAL_STATE_FILE):
         try:
-            with open(GLOBAL_STATE_FILE, 'r') as f:
-                loaded = json.load(f)
-                state = ensure_state_keys(loaded)
+            loaded = read_json_file(GLOBAL_STATE_FILE)
+            state = ensure_state_keys(loaded)
         except Exception as e:
             logger.error(f"Global state file corrupted ({e}). Starting fresh.")
     return state
 
 def save_global_state(state):
+    global LAST_GLOBAL_SAVE
     state = ensure_state_keys(state)
     atomic_write_json(GLOBAL_STATE_FILE, state)
+    LAST_GLOBAL_SAVE = time.monotonic()
+
+def maybe_save_global_state(state):
+    """Guarda como mucho cada GLOBAL_SAVE_INTERVAL; main() y la señal hacen el guardado final"""
+    if time.monotonic() - LAST_GLOBAL_SAVE >= GLOBAL_SAVE_INTERVAL:
+        save_global_state(state)
+
+@functools.lru_cache(maxsize=4096)
+def get_domain_folder(domain):
+    domain_safe = domain.split("://", 1)[-1].translate(_SAFE_TRANS)
+    return os.path.join(DATA_DIR, "domains", domain_safe)
 
 def get_domain_state_path(domain):
-    domain_safe = domain.replace("http://", "").replace("https://", "").replace("/", "_").replace(".", "_")
-    return os.path.join(DATA_DIR, "domains", domain_safe, "state.json")
+    return os.path.join(get_domain_folder(domain), "state.json")
+
+def get_domain_journal_path(domain):
+    return os.path.join(os.path.dirname(get_domain_state_path(domain)), "state.jsonl")
+
+def get_domain_visited_path(domain):
+    return os.path.join(get_domain_folder(domain), "visited.u64")
+
+def pack_visited_keys(keys):
+    """Huellas como uint64 little-endian contiguos"""
+    keys = array('Q', keys)
+    if sys.byteorder == 'big':
+        keys.byteswap()
+    return keys.tobytes()
+
+def load_domain_visited(domain, state):
+    """Huellas visitadas: archivo empaquetado de uint64 más lo que quede en estados antiguos"""
+    # Los estados antiguos guardaban URLs en state.json; se convierten al cargar. Las huellas
+    # enteras de formatos intermedios eran de la URL sin canonizar y ya no coinciden: se descartan
+    legacy = {_url_key(v) for v in state.pop('visited', []) if isinstance(v, str)}
+    visited = set(legacy)
+    path = get_domain_visited_path(domain)
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            keys = array('Q')
+            keys.frombytes(raw[:len(raw) - len(raw) % keys.itemsize])  # Último registro cortado por un kill
+            if sys.byteorder == 'big':
+                keys.byteswap()
+            visited.update(keys)
+        except Exception as e:
+            logger.error(f"Failed to load visited set {path}: {e}")
+    if legacy:
+        save_domain_visited(domain, visited)
+    return visited
+
+def save_domain_visited(domain, visited):
+    """Reescribe el conjunto completo de forma atómica (solo al migrar estados antiguos)"""
+    path = get_domain_visited_path(domain)
+    try:
+        write_file(path + ".tmp", pack_visited_keys(visited))
+        os.replace(path + ".tmp", path)
+    except Exception as e:
+        logger.error(f"Failed to write visited set {path}: {e}")
+
+def open_domain_visited_log(domain):
+    """visited.u64 es append-only: las URLs terminadas se añaden en cada checkpoint, tras la cola"""
+    path = get_domain_visited_path(domain)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return open(path, 'ab')
+
+def get_domain_queue_path(domain):
+    return os.path.join(get_domain_folder(domain), "queue.txt")
+
+def load_domain_queue(domain, state):
+    """Cola pendiente: una URL por línea (las URLs no contienen saltos de línea)"""
+    queue = state.pop('queues', None) or []  # Estados antiguos guardaban la cola en state.json
+    path = get_domain_queue_path(domain)
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                queue.extend(line.decode('utf-8') for line in f.read().split(b"\n") if line)
+        except Exception as e:
+            logger.error(f"Failed to load queue {path}: {e}")
+    return queue
+
+def save_domain_queue(domain, urls):
+    path = get_domain_queue_path(domain)
+    try:
+        if urls:
+            write_file(path + ".tmp", "\n".join(urls).encode('utf-8'))
+            os.replace(path + ".tmp", path)
+        elif os.path.exists(path):
+            os.remove(path)
+    except Exception as e:
+        logger.error(f"Failed to write queue {path}: {e}")
+
+def open_domain_journal(domain):
+    """Journal append-only con los file_meta nuevos; se compacta en state.json al cerrar el dominio"""
+    path = get_domain_journal_path(domain)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return open(path, 'ab')
+
+def replay_domain_journal(domain, state):
+    """Aplica sobre el snapshot las entradas de un journal que no llegó a compactarse"""
+    path = get_domain_journal_path(domain)
+    if not os.path.exists(path):
+        return state
+    file_meta = state.setdefault('file_meta', {})
+    replayed = 0
+    try:
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json_loads(line)
+                except ValueError:
+                    continue  # Última línea truncada por un corte
+                file_meta[record['url']] = record['meta']
+                replayed += 1
+    except Exception as e:
+        logger.error(f"Failed to replay journal {path}: {e}")
+    if replayed:
+        logger.info(f"Replayed {replayed} journal entries for {domain}")
+    return state
 
 def load_domain_state(domain):
     path = get_domain_state_path(domain)
-    default_state = {"file_meta": {}, "queues": [], "visited": [], "errors": {}}
+    default_state = {"file_meta": {}, "errors": {}}
     if os.path.exists(path):
         try:
-            with open(path, 'r') as f:
-                loaded = json.load(f)
-                if isinstance(loaded, dict):
-                    return loaded
+            loaded = read_json_file(path)
+            if isinstance(loaded, dict):
+                return replay_domain_journal(domain, loaded)
         except: pass
-    return default_state
+    return replay_domain_journal(domain, default_state)
 
 def save_domain_state(domain, state):
+    """Escribe el snapshot completo y, si se guardó bien, vacía el journal"""
     path = get_domain_state_path(domain)
-    atomic_write_json(path, state)
+    if atomic_write_json(path, state):
+        journal_path = get_domain_journal_path(domain)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
 
-def update_stats(global_state, domain, key, increment=1):
+def checkpoint_domain_state(domain, state, queue, pending, visited_log, new_keys, dirty=True):
+    """Cola, snapshot y visitados nuevos, en ese orden; las URLs aún en vuelo vuelven a la cola.
+    Un corte entre medias solo puede repetir descargas: una URL nunca consta como visitada
+    sin que los hijos que encoló estén ya en queue.txt."""
+    save_domain_queue(domain, list(pending) + list(queue))
+    if dirty:
+        save_domain_state(domain, state)
+    else:
+        # Sin cambios desde el último snapshot: solo sobra el journal vacío recién abierto
+        journal_path = get_domain_journal_path(domain)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+    visited_log.write(pack_visited_keys(new_keys))
+    visited_log.flush()
+
+def get_domain_stats(global_state, domain):
     if "domain_stats" not in global_state:
         global_state["domain_stats"] = {}
         
@@ -136,10 +420,24 @@ def update_stats(global_state, domain, key, increment=1):
             "last_crawl": None, "avg_download_time": 0
         }
     
-    stats = global_state['domain_stats'][domain]
+    return global_state['domain_stats'][domain]
+
+def update_stats(global_state, domain, key, increment=1):
+    stats = get_domain_stats(global_state, domain)
     if key in stats:
         stats[key] += increment
 
+def fold_stats(global_state, domain, delta, time_sum, time_count):
+    """Aplica de una vez los contadores de una tanda de descargas"""
+    stats = get_domain_stats(global_state, domain)
+    # Promedio incremental: el tiempo de la tanda se pondera contra las descargas previas
+    if time_count:
+        count = stats.get("sitemaps_downloaded", 0)
+        stats["avg_download_time"] = (stats.get("avg_download_time", 0) * count + time_sum) / (count + time_count)
+    for key, increment in delta.items():
+        if key in stats:
+            stats[key] += increment
+
 def normalize_domain(domain):
     """Normaliza el dominio para evitar duplicados HTTP/HTTPS"""
     if not domain.startswith(('http://', 'https://')):
@@ -151,11 +449,55 @@ def validate_url(url, base_domain):
     """Valida que una URL pertenezca al dominio base"""
     try:
         parsed = urlparse(url)
-        base_parsed = urlparse(base_domain)
+        base_parsed = _parse(base_domain)
         return parsed.netloc == base_parsed.netloc
     except:
         return False
 
+def _same_host(url, base_netloc):
+    """Equivalente rápido de validate_url para el filtrado de <loc>: compara el netloc sin urlparse"""
+    i = url.find('://')
+    if i <= 0 or not url[:i].isalpha():
+        # Sin esquema delante (p. ej. "/p?u=https://..."): parseo completo, como validate_url
+        return urlparse(url).netloc == base_netloc
+    end = i + 3 + len(base_netloc)
+    return url.startswith(base_netloc, i + 3) and (end == len(url) or url[end] in '/?#')
+
+# Estados BLAKE2b ya inicializados: copy() es más barato que construir uno nuevo por URL
+_BLAKE_SHORT = hashlib.blake2b(digest_size=3)
+_BLAKE_KEY = hashlib.blake2b(digest_size=8)
+
+@functools.lru_cache(maxsize=4096)
+def _parse(url):
+    return urlparse(url)
+
+@functools.lru_cache(maxsize=None)
+def _url_hash(url):
+    """Sufijo corto y estable (entre ejecuciones) para nombrar el archivo de cada sitemap"""
+    h = _BLAKE_SHORT.copy()
+    h.update(url.encode('utf-8', 'ignore'))
+    return h.hexdigest()
+
+def canonical_url(url):
+    """Forma canónica para deduplicar variantes de la misma URL: sin esquema ni fragmento,
+    host en minúsculas, sin puerto por defecto y sin barra final"""
+    try:
+        parsed = urlsplit(url.strip())
+        port = parsed.port
+    except ValueError:
+        return url
+    host = parsed.hostname or ''
+    netloc = f"{host}:{port}" if port and port not in (80, 443) else host
+    path = parsed.path.rstrip('/') or '/'
+    return f"//{netloc}{path}?{parsed.query}" if parsed.query else f"//{netloc}{path}"
+
+def _url_key(url):
+    """Huella de 64 bits de la URL canónica para el conjunto `visited` (8 bytes en vez de la URL entera).
+    La petición y los nombres de archivo siguen usando la URL original."""
+    h = _BLAKE_KEY.copy()
+    h.update(canonical_url(url).encode('utf-8', 'ignore'))
+    return int.from_bytes(h.digest(), 'big')
+
 def get_random_user_agent():
     """Selecciona un User-Agent aleatorio de la lista"""
     return random.choice(USER_AGENTS)
@@ -167,84 +509,121 @@ def check_domain_exists(domain):
         tuple: (exists, error_message)
     """
     try:
-        parsed = urlparse(domain)
-        hostname = parsed.netloc
-        
-        # Verificar resolución DNS
-        socket.gethostbyname(hostname)
-        
-        # Intentar una conexión simple
-        response = requests.get(
+        # La propia petición resuelve el DNS (un fallo llega como ConnectionError), sin
+        # un gethostbyname previo. stream=True: solo interesa el código, no descargar la portada
+        with SESSION.get(
             domain, 
             headers={"User-Agent": get_random_user_agent()}, 
             timeout=10,
-            allow_redirects=True
-        )
+            allow_redirects=True,
+            stream=True
+        ) as response:
+            status_code = response.status_code
         
-        if response.status_code >= 400:
-            return False, f"Domain returned HTTP {response.status_code}"
+        if status_code >= 400:
+            return False, f"Domain returned HTTP {status_code}"
             
         return True, None
-    except socket.gaierror:
-        return False, "DNS resolution failed"
     except requests.exceptions.RequestException as e:
         return False, f"Connection error: {str(e)}"
     except Exception as e:
         return False, f"Unknown error: {str(e)}"
 
-def parse_robots_txt(domain):
+def parse_robots_txt(domain, cached=None):
     """
     Parsea el archivo robots.txt y extrae los sitemaps declarados.
+    Con `cached` (resultado de una ejecución anterior) reciente no se hace petición;
+    si ha caducado se hace un GET condicional y un 304 reutiliza sus valores.
+    Un 4xx también se cachea (no hay robots.txt); un fallo transitorio conserva lo
+    anterior y solo se guarda durante ROBOTS_FAILURE_TTL.
     Returns:
-        tuple: (sitemaps, crawl_delay)
+        tuple: (sitemaps, crawl_delay, cache)
     """
     sitemaps = []
     crawl_delay = DEFAULT_CRAWL_DELAY
+    cache = {}
+    failed = False
+    
+    if cached and time.time() - cached.get('fetched_at', 0) < cached.get('ttl', ROBOTS_CACHE_TTL):
+        logger.info(f"Using cached robots.txt for {domain}")
+        return cached.get('sitemaps', []), cached.get('crawl_delay', DEFAULT_CRAWL_DELAY), cached
     
     try:
         robots_url = urljoin(domain, "/robots.txt")
         logger.info(f"Checking robots.txt at {robots_url}")
         
-        response = requests.get(
+        headers = {"User-Agent": get_random_user_agent()}
+        if cached:
+            if cached.get('etag'): headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'): headers['If-Modified-Since'] = cached['last_modified']
+        
+        response = SESSION.get(
             robots_url, 
-            headers={"User-Agent": get_random_user_agent()}, 
+            headers=headers, 
             timeout=TIMEOUT
         )
         
+        if response.status_code == 304 and cached:
+            logger.info(f"robots.txt not modified for {domain}, using cached values")
+            refreshed = dict(cached, fetched_at=time.time())
+            refreshed.pop('ttl', None)
+            return cached.get('sitemaps', []), cached.get('crawl_delay', DEFAULT_CRAWL_DELAY), refreshed
+        
         if response.status_code == 200:
-            content = response.text
+            content = response.content
             logger.info(f"robots.txt found for {domain}")
             
-            # Extraer sitemaps del robots.txt
-            for line in content.splitlines():
-                line = line.strip()
-                if line.lower().startswith("sitemap:"):
-                    sitemap_url = line.split(":", 1)[1].strip()
-                    if sitemap_url:
-                        sitemaps.append(sitemap_url)
-                elif line.lower().startswith("crawl-delay"):
-                    try:
-                        delay = float(line.split(":", 1)[1].strip())
-                        if delay > 0:
-                            crawl_delay = max(crawl_delay, delay)
-                            logger.info(f"Crawl delay set to {crawl_delay}s from robots.txt")
-                    except ValueError:
-                        pass
-        else:
+            # Extraer sitemaps y crawl-delay con una pasada de regex sobre los bytes
+            sitemaps = [m.group(1).decode('ascii', 'ignore') for m in RE_ROBOTS_SITEMAP.finditer(content)]
+            for m in RE_ROBOTS_CRAWL_DELAY.finditer(content):
+                try:
+                    delay = float(m.group(1))
+                except ValueError:
+                    continue
+                if delay > crawl_delay:
+                    crawl_delay = delay
+            if crawl_delay != DEFAULT_CRAWL_DELAY:
+                logger.info(f"Crawl delay set to {crawl_delay}s from robots.txt")
+            cache = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'sitemaps': sitemaps,
+                'crawl_delay': crawl_delay,
+                'fetched_at': time.time()
+            }
+        elif 400 <= response.status_code < 500 and response.status_code != 429:
             logger.warning(f"robots.txt not found (HTTP {response.status_code}) for {domain}")
+            cache = {'sitemaps': [], 'crawl_delay': crawl_delay, 'fetched_at': time.time()}
+        else:
+            logger.warning(f"robots.txt unavailable (HTTP {response.status_code}) for {domain}")
+            failed = True
     except Exception as e:
         logger.warning(f"Error parsing robots.txt for {domain}: {str(e)}")
+        failed = True
+    
+    if failed:
+        # Se mantienen los sitemaps y el delay anteriores (o los por defecto) y se reintenta en breve
+        if cached:
+            sitemaps = cached.get('sitemaps', [])
+            crawl_delay = cached.get('crawl_delay', DEFAULT_CRAWL_DELAY)
+        cache = dict(cached or {}, sitemaps=sitemaps, crawl_delay=crawl_delay,
+                     fetched_at=time.time(), ttl=ROBOTS_FAILURE_TTL)
     
-    return sitemaps, crawl_delay
+    return sitemaps, crawl_delay, cache
 
-def get_with_retry(url, headers, max_retries=MAX_URL_RETRIES):
+def get_with_retry(url, headers, max_retries=MAX_URL_RETRIES, stream=False):
     """Implementa un retraso exponencial para reintentos con User-Agent aleatorio"""
+    response = None
     for attempt in range(max_retries):
         try:
             # Añadir User-Agent aleatorio en cada intento
             headers["User-Agent"] = get_random_user_agent()
             
-            response = requests.get(url, headers=headers, timeout=TIMEOUT)
+            response = SESSION.get(url, headers=headers, timeout=TIMEOUT, stream=stream)
+            
+            # Una respuesta en streaming que se descarta debe liberar su conexión al pool
+            if response.status_code in (429, 403):
+                response.close()
             
             # Manejar específicamente el código 429 (Too Many Requests)
             if response.status_code == 429:
@@ -264,56 +643,145 @@ def get_with_retry(url, headers, max_retries=MAX_URL_RETRIES):
             if attempt == max_retries - 1:
                 raise
             time.sleep(2 ** attempt)
-    return None
+    # Reintentos agotados por 429/403: se devuelve la última respuesta para que el llamador vea el código
+    return response
+
+def read_body(response):
+    """
+    Lee el cuerpo de la respuesta. Si viaja con Content-Encoding gzip se leen los bytes
+    tal cual llegan para poder guardarlos sin recomprimir.
+    Returns:
+        tuple: (cuerpo descomprimido, bytes gzip del cable o None)
+    """
+    if response.headers.get('Content-Encoding', '').lower() in ('gzip', 'x-gzip'):
+        wire = response.raw.read(decode_content=False)
+        return gzip_decompress(wire), wire
+    return response.content, None
 
 # --- CRAWLER LOGIC ---
 
-def process_url(url, domain_folder, domain_state, crawl_delay, base_domain):
-    time.sleep(crawl_delay + random.uniform(0, 0.5))  # Aumentado el random para más variabilidad
-    headers = {
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-        "Accept-Language": "en-US,en;q=0.5",
-        "Accept-Encoding": "gzip, deflate",
-        "DNT": "1",
-        "Connection": "keep-alive",
-        "Upgrade-Insecure-Requests": "1"
-    }
+@dataclass(slots=True)
+class FetchResult:
+    """Resultado de process_url; meta sigue siendo un dict porque va tal cual al journal"""
+    url: str
+    success: bool
+    status: str
+    is_index: bool = False
+    meta: dict | None = None
+    locs: list | tuple = ()
+    size: int = 0
+    download_time: float = 0.0
+    save_path: str | None = None  # Solo en DOWNLOADED: el hilo del dominio lo encola al escritor
+    stored: bytes | None = None
+
+def parse_sitemap_regex(content):
+    """Clasificación por regex sobre los bytes (fallback sin lxml o XML roto); solo se decodifican los <loc>"""
+    is_index = False
+    is_rich = False
+    locs = []
+    append = locs.append
+    for m in RE_SITEMAP_SCAN.finditer(content):
+        kind = m.lastgroup
+        if kind == 'loc':
+            append(m.group('loc').decode('utf-8', 'ignore').strip())
+        elif kind == 'idx':
+            is_index = True
+        elif not is_index:
+            is_rich = True
+    return is_index, is_rich, locs
+
+def parse_sitemap(content):
+    """
+    Clasifica un sitemap y extrae sus <loc> en una sola pasada con lxml.iterparse.
+    Returns:
+        tuple: (is_index, is_rich, locs)
+    """
+    if etree is None:
+        return parse_sitemap_regex(content)
+    
+    is_index = False
+    is_rich = False
+    locs = []
+    root_seen = False
+    try:
+        # Solo eventos "end": la raíz se obtiene del árbol en el primero
+        for _, el in etree.iterparse(io.BytesIO(content), events=("end",), huge_tree=True):
+            if not root_seen:
+                root_seen = True
+                # En un índice la riqueza no cambia la carpeta destino: ya no se comprueba
+                is_index = str(el.getroottree().getroot().tag).rpartition('}')[2] == "sitemapindex"
+            if not isinstance(el.tag, str):
+                continue
+            local = el.tag.rpartition('}')[2]
+            # Como el regex `<loc>`: sin prefijo, en cualquier namespace por defecto (0.9, https,
+            # 0.84...); <image:loc> y similares no son páginas
+            if local == "loc" and el.prefix is None:
+                if el.text:
+                    locs.append(el.text.strip())
+            elif not (is_rich or is_index) and (el.prefix, local) in RICH_TAGS:
+                is_rich = True
+            el.clear()
+            # clear() deja el nodo vacío colgando de la raíz: se sueltan las entradas ya procesadas
+            if local in ("url", "sitemap"):
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+    except etree.XMLSyntaxError:
+        return parse_sitemap_regex(content)
     
-    cached_meta = domain_state.get('file_meta', {}).get(url, {})
+    if not root_seen:
+        return parse_sitemap_regex(content)
+    return is_index, is_rich, locs
+
+def process_url(url, file_meta, domain_folder, base_domain):
+    headers = {}
+    cached_meta = file_meta.get(url, {})
     if cached_meta.get('etag'): headers['If-None-Match'] = cached_meta['etag']
     if cached_meta.get('last_modified'): headers['If-Modified-Since'] = cached_meta['last_modified']
 
     start_time = time.time()
     try:
-        response = get_with_retry(url, headers)
+        with get_with_retry(url, headers, stream=True) as response:
+            if response.status_code == 304:
+                return FetchResult(url, True, "NOT_MODIFIED", cached_meta.get('is_index', False), download_time=time.time() - start_time)
+            
+            if response.status_code != 200:
+                return FetchResult(url, False, f"HTTP_{response.status_code}", download_time=time.time() - start_time)
+            
+            content, wire = read_body(response)
         download_time = time.time() - start_time
         
-        if response.status_code == 304:
-            return (url, True, cached_meta.get('is_index', False), None, [], "NOT_MODIFIED", 0, download_time)
+        body_hash = hashlib.blake2b(content, digest_size=16).hexdigest()
+        if cached_meta.get('body_hash') == body_hash:
+            # Servidor sin ETag/Last-Modified útiles pero cuerpo idéntico: no se reescribe ni se reclasifica
+            same_meta = dict(cached_meta,
+                             etag=response.headers.get('ETag'),
+                             last_modified=response.headers.get('Last-Modified'),
+                             last_check=time.time())
+            return FetchResult(url, True, "UNCHANGED", cached_meta.get('is_index', False), same_meta, size=len(content),
+                               download_time=download_time)
         
-        if response.status_code != 200:
-            return (url, False, False, None, [], f"HTTP_{response.status_code}", 0, download_time)
-
-        content = response.content
-        text_content = content.decode('utf-8', 'ignore')
-        
-        is_index = bool(RE_SITEMAP_INDEX.search(text_content))
-        is_rich = bool(RE_RICH_METADATA.search(text_content))
+        # Un .xml.gz llega comprimido: se parsea descomprimido y se guarda tal cual
+        compressed = content[:2] == GZIP_MAGIC
+        xml_content = gzip_decompress(content) if compressed else content
+        if compressed:
+            stored = content
+        elif wire is not None:
+            # Content-Encoding gzip: los bytes del cable ya son el .gz a guardar
+            stored = wire
+        else:
+            # Sin marca de tiempo: un sitemap sin cambios produce el mismo .gz y no ensucia la rama de datos
+            stored = gzip_compress(content)
+        is_index, is_rich, locs = parse_sitemap(xml_content)
         subfolder = "indices" if is_index else ("content_rich" if is_rich else "content_raw")
         
         parsed = urlparse(url)
         name = os.path.basename(parsed.path) or "sitemap"
-        url_hash = hex(abs(hash(url)))[2:][:6] 
-        save_dir = os.path.join(domain_folder, subfolder)
-        os.makedirs(save_dir, exist_ok=True)
-        save_path = os.path.join(save_dir, f"{name}_{url_hash}.xml.gz")
-        
-        with gzip.open(save_path, "wb") as f:
-            f.write(content)
+        url_hash = _url_hash(url)
+        save_path = os.path.join(domain_folder, subfolder, f"{name}_{url_hash}.xml.gz")
             
-        locs = [l.strip() for l in RE_LOC.findall(text_content)]
         # Filtrar URLs para mantener solo las del mismo dominio
-        valid_locs = [l for l in locs if validate_url(l, base_domain)]
+        base_netloc = _parse(base_domain).netloc
+        valid_locs = [l for l in locs if _same_host(l, base_netloc)]
         
         new_meta = {
             'etag': response.headers.get('ETag'),
@@ -321,18 +789,21 @@ def process_url(url, domain_folder, domain_state, crawl_delay, base_domain):
             'is_index': is_index,
             'is_rich': is_rich,
             'urls_count': len(valid_locs),
-            'last_check': datetime.now().isoformat()
+            'compressed': compressed,
+            'body_hash': body_hash,
+            'last_check': time.time()  # epoch: más corto que ISO en el journal
         }
         
-        return (url, True, is_index, new_meta, valid_locs, "DOWNLOADED", len(content), download_time)
+        return FetchResult(url, True, "DOWNLOADED", is_index, new_meta, valid_locs, len(content), download_time,
+                           save_path, stored)
     except requests.exceptions.Timeout:
-        return (url, False, False, None, [], "TIMEOUT", 0, time.time() - start_time)
+        return FetchResult(url, False, "TIMEOUT", download_time=time.time() - start_time)
     except requests.exceptions.ConnectionError:
-        return (url, False, False, None, [], "CONNECTION_ERROR", 0, time.time() - start_time)
+        return FetchResult(url, False, "CONNECTION_ERROR", download_time=time.time() - start_time)
     except Exception as e:
-        return (url, False, False, None, [], str(e), 0, time.time() - start_time)
+        return FetchResult(url, False, str(e), download_time=time.time() - start_time)
 
-def process_site(domain, global_state):
+def process_site(domain, global_state, lock):
     global FILES_PROCESSED_THIS_RUN
     logger.info(f"=== Site: {domain} ===")
     
@@ -343,16 +814,22 @@ def process_site(domain, global_state):
     domain_exists, error_msg = check_domain_exists(domain)
     if not domain_exists:
         logger.error(f"Domain {domain} is not accessible: {error_msg}")
-        update_stats(global_state, domain, "errors_total", 5)  # Penalizar errores de dominio
+        with lock:
+            update_stats(global_state, domain, "errors_total", 5)  # Penalizar errores de dominio
         return
     
     domain_state = load_domain_state(domain)
-    domain_name_clean = urlparse(domain).netloc or domain.replace("https://", "").replace("http://", "")
-    domain_folder = os.path.join(DATA_DIR, "domains", domain_name_clean.replace(".", "_"))
+    # El snapshot solo se reescribe si algo cambió: journal con entradas, robots nuevo o
+    # claves antiguas que se migran a sus propios archivos
+    dirty = 'visited' in domain_state or 'queues' in domain_state
+    journal = open_domain_journal(domain)
+    domain_folder = get_domain_folder(domain)
     
     # Discovery - Parsear robots.txt primero
     logger.info(f"Discovering sitemaps for {domain}")
-    sitemaps_from_robots, crawl_delay = parse_robots_txt(domain)
+    cached_robots = domain_state.get('robots')
+    sitemaps_from_robots, crawl_delay, domain_state['robots'] = parse_robots_txt(domain, cached_robots)
+    dirty = dirty or domain_state['robots'] != cached_robots
     
     # Crear conjunto de URLs de sitemap
     seeds = set()
@@ -369,106 +846,238 @@ def process_site(domain, global_state):
         for path in COMMON_PATHS:
             seeds.add(urljoin(domain, path))
 
-    if domain_state.get('queues'):
-        queue = deque(domain_state['queues'])
+    saved_queue = load_domain_queue(domain, domain_state)
+    if saved_queue:
+        queue = deque(saved_queue)
     else:
         queue = deque(list(seeds))
         
-    visited = set(domain_state.get('visited', []))
+    visited = load_domain_visited(domain, domain_state)
+    visited_log = open_domain_visited_log(domain)
+    unsaved_keys = []  # URLs terminadas desde el último checkpoint; van a visited.u64 junto con la cola
     consecutive_failures = 0
+    circuit_open = False
+    inflight = {}
+    journal_entries = 0
+    next_slot = time.monotonic()  # Próximo instante en que se puede lanzar una petición al dominio
     
     logger.info(f"Using crawl delay of {crawl_delay}s for {domain}")
+    base_delay = crawl_delay
+    success_streak = 0
+    
+    for subfolder in SUBFOLDERS:
+        ensure_dir(os.path.join(domain_folder, subfolder))
+    write_q = Queue(maxsize=WRITE_QUEUE_SIZE)
+    written_q = Queue()
+    threading.Thread(target=file_writer, args=(write_q, written_q), daemon=True).start()
+    awaiting_write = {}  # url -> FetchResult descargado cuyo archivo aún no está en disco
+    
+    # Los argumentos fijos del dominio se enlazan una vez; cada envío solo pasa la URL
+    file_meta = domain_state.setdefault('file_meta', {})
+    fetch = functools.partial(process_url, file_meta=file_meta, domain_folder=domain_folder,
+                              base_domain=domain)
+    
+    def collect_writes(entries, done_keys, delta):
+        """Registra los sitemaps cuyo archivo ya está en disco. Un fallo de escritura cuenta como
+        descarga fallida y no deja meta, para que la próxima vez no llegue un 304 sin archivo.
+        Devuelve True si algún índice añadió URLs a la cola."""
+        queued = len(queue)
+        while True:
+            try:
+                url, error = written_q.get_nowait()
+            except Empty:
+                return len(queue) > queued
+            res = awaiting_write.pop(url)
+            done_keys.append(_url_key(url))
+            if error:
+                delta["errors_total"] += 1
+                logger.warning(f"  [ERR] {url}: WRITE_ERROR")
+                continue
+            delta["sitemaps_downloaded"] += 1
+            delta["urls_discovered"] += res.meta['urls_count']
+            if res.is_index: delta["index_count"] += 1
+            if res.meta['is_rich']: delta["rich_content_count"] += 1
+            
+            file_meta[url] = res.meta
+            entries.append(json_dumps({"url": url, "meta": res.meta}))
+            if res.is_index:
+                # Un solo extend; dict.fromkeys quita repetidos del propio índice.
+                # visited se marca al lanzar la descarga, no aquí, para que un
+                # checkpoint no dé por visitadas URLs que siguen en la cola
+                queue.extend(l for l in dict.fromkeys(res.locs) if _url_key(l) not in visited)
+            logger.info(f"  [OK] {url} (+{res.meta['urls_count']} urls, {res.download_time:.2f}s)")
     
     try:
         with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            while queue and FILES_PROCESSED_THIS_RUN < MAX_FILES_PER_RUN:
-                if get_elapsed_time() > TIME_LIMIT_SECONDS or not check_disk_space():
-                    break
+            # Ventana deslizante: en cuanto termina una descarga se lanza la siguiente,
+            # sin esperar al más lento de un lote. El crawl delay se aplica aquí, al lanzar
+            # cada petición, y no durmiendo dentro de los workers.
+            while queue or inflight or awaiting_write:
+                stopping = (circuit_open or STOP_EVENT.is_set() or FILES_PROCESSED_THIS_RUN >= MAX_FILES_PER_RUN
+                            or get_elapsed_time() > TIME_LIMIT_SECONDS or not check_disk_space())
                 
-                batch = []
-                while queue and len(batch) < MAX_WORKERS:
+                now = time.monotonic()
+                while not stopping and queue and len(inflight) < MAX_WORKERS and now >= next_slot:
                     u = queue.popleft()
-                    if u not in visited:
-                        visited.add(u)
-                        batch.append(u)
-                
-                if not batch: continue
+                    key = _url_key(u)
+                    if key not in visited:
+                        visited.add(key)
+                        inflight[executor.submit(fetch, u)] = u
+                        next_slot = now + crawl_delay + random.uniform(0, 0.5)
                 
-                futures = {executor.submit(process_url, u, domain_folder, domain_state, crawl_delay, domain): u for u in batch}
-                for future in as_completed(futures):
-                    url = futures[future]
+                can_submit = not stopping and queue and len(inflight) < MAX_WORKERS
+                if inflight:
+                    # Con hueco libre se espera como mucho hasta el siguiente turno de envío
+                    timeout = max(0, next_slot - time.monotonic()) if can_submit else None
+                    done, _ = wait(inflight, timeout=timeout, return_when=FIRST_COMPLETED)
+                elif awaiting_write and not can_submit:
+                    # Solo quedan archivos por escribir: un índice entre ellos puede traer más URLs
+                    write_q.join()
+                    done = ()
+                elif can_submit:
+                    STOP_EVENT.wait(max(0, next_slot - time.monotonic()))
+                    continue
+                else:
+                    break
+                entries = []
+                # Contadores de la tanda: el estado global se toca una sola vez, bajo el lock
+                delta = Counter()
+                time_sum, time_count = 0.0, 0
+                for future in done:
+                    url = inflight.pop(future)
                     try:
                         res = future.result()
-                        url, success, is_index, meta, locs, status, b_size, download_time = res
                         
-                        # Actualizar tiempo promedio de descarga
-                        if "domain_stats" in global_state and domain in global_state["domain_stats"]:
-                            stats = global_state["domain_stats"][domain]
-                            if "avg_download_time" in stats:
-                                # Calcular nuevo promedio
-                                current_avg = stats["avg_download_time"]
-                                count = stats.get("sitemaps_downloaded", 0)
-                                if count > 0:
-                                    stats["avg_download_time"] = (current_avg * count + download_time) / (count + 1)
-                                else:
-                                    stats["avg_download_time"] = download_time
+                        delta["bytes_processed"] += res.size
+                        time_sum += res.download_time
+                        time_count += 1
                         
-                        update_stats(global_state, domain, "bytes_processed", b_size)
-                        
-                        if success or status == "NOT_MODIFIED":
+                        if res.success or res.status == "NOT_MODIFIED":
                             consecutive_failures = 0
-                            if status != "NOT_MODIFIED":
-                                FILES_PROCESSED_THIS_RUN += 1
-                                update_stats(global_state, domain, "sitemaps_downloaded")
-                                update_stats(global_state, domain, "urls_discovered", meta['urls_count'])
-                                if is_index: update_stats(global_state, domain, "index_count")
-                                if meta['is_rich']: update_stats(global_state, domain, "rich_content_count")
-                                
-                                if 'file_meta' not in domain_state: domain_state['file_meta'] = {}
-                                domain_state['file_meta'][url] = meta
-                                if is_index:
-                                    for l in locs:
-                                        if l not in visited: queue.append(l)
-                                logger.info(f"  [OK] {url} (+{meta['urls_count']} urls, {download_time:.2f}s)")
+                            # AIMD: el retraso sube x1.5 con 403/429 y baja poco a poco con éxitos seguidos
+                            success_streak += 1
+                            if success_streak >= DELAY_RECOVERY_STREAK and crawl_delay > base_delay:
+                                crawl_delay = max(base_delay, crawl_delay - DELAY_RECOVERY_STEP)
+                                success_streak = 0
+                                logger.info(f"Crawl delay for {domain} relaxed to {crawl_delay}s")
+                            if res.status == "UNCHANGED":
+                                # Mismo cuerpo que en la última descarga: solo se refresca el meta
+                                file_meta[url] = res.meta
+                                entries.append(json_dumps({"url": url, "meta": res.meta}))
+                                logger.info(f"  [SAME] {url}")
+                            elif res.status != "NOT_MODIFIED":
+                                # Meta, hijos y estadísticas esperan a que el escritor confirme el archivo.
+                                # Se encola desde este hilo, después de registrarlo en awaiting_write,
+                                # para que ninguna confirmación llegue antes que su resultado
+                                awaiting_write[url] = res
+                                write_q.put((res.save_path, res.stored, url))
+                                res.stored = None  # El cuerpo ya solo lo necesita el escritor
                             else:
                                 logger.info(f"  [CACHE] {url}")
                         else:
-                            update_stats(global_state, domain, "errors_total")
+                            delta["errors_total"] += 1
                             consecutive_failures += 1
-                            
-                            # Manejo específico para errores 403
-                            if "HTTP_403" in status:
-                                logger.warning(f"Access forbidden (403) for {url}. Increasing delay...")
+                            success_streak = 0
+                        
+                            # Manejo específico para errores 403 y 429
+                            if res.status in ("HTTP_403", "HTTP_429"):
+                                logger.warning(f"Access forbidden or rate limited ({res.status}) for {url}. Increasing delay...")
                                 # Aumentar el retraso para este dominio
                                 crawl_delay = min(crawl_delay * 1.5, 10.0)
                                 logger.warning(f"New crawl delay for {domain}: {crawl_delay}s")
-                            
-                            logger.warning(f"  [ERR] {url}: {status}")
+                        
+                            logger.warning(f"  [ERR] {url}: {res.status}")
                     except Exception as e:
                         logger.error(f"Error processing future for {url}: {e}")
+                    if url not in awaiting_write:
+                        unsaved_keys.append(_url_key(url))
+                
+                # Antes de un checkpoint se espera al escritor: así ninguna URL descargada queda
+                # fuera a la vez de la cola guardada y de los visitados
+                compact = (journal_entries + len(entries) + len(awaiting_write) >= JOURNAL_COMPACT_EVERY
+                           or len(unsaved_keys) >= JOURNAL_COMPACT_EVERY)
+                if compact:
+                    write_q.join()
+                queued_children = collect_writes(entries, unsaved_keys, delta)
+                
+                if delta or time_count:
+                    with lock:
+                        fold_stats(global_state, domain, delta, time_sum, time_count)
+                        FILES_PROCESSED_THIS_RUN += delta["sitemaps_downloaded"]
+                
+                # Los hijos de un índice se guardan antes que su meta: con el meta en el journal,
+                # la próxima ejecución recibiría un 304/UNCHANGED y no volvería a encolarlos
+                if queued_children:
+                    save_domain_queue(domain, list(inflight.values()) + list(awaiting_write) + list(queue))
+                
+                # Un solo write + flush por tanda de descargas terminadas
+                if entries:
+                    journal.write(b"\n".join(entries) + b"\n")
+                    journal.flush()
+                    journal_entries += len(entries)
+                
+                # Compactación periódica: acota el journal y persiste cola y visitados ante un kill
+                if compact:
+                    dirty = dirty or journal.tell() > 0
+                    journal.close()
+                    checkpoint_domain_state(domain, domain_state, queue, inflight.values(),
+                                            visited_log, unsaved_keys, dirty)
+                    journal = open_domain_journal(domain)
+                    journal_entries = 0
+                    unsaved_keys.clear()
+                    dirty = False
 
-                if consecutive_failures > DOMAIN_FAILURE_LIMIT:
+                if consecutive_failures > DOMAIN_FAILURE_LIMIT and not circuit_open:
                     logger.error(f"Circuit breaker triggered for {domain}")
-                    break
+                    circuit_open = True
     finally:
-        if "domain_stats" not in global_state: global_state["domain_stats"] = {}
-        if domain not in global_state["domain_stats"]:
-            update_stats(global_state, domain, "bytes_processed", 0)
-        
-        global_state['domain_stats'][domain]['last_crawl'] = datetime.now().isoformat()
-        domain_state['queues'] = list(queue)
-        domain_state['visited'] = list(visited)
-        save_domain_state(domain, domain_state)
-        save_global_state(global_state)
+        # Vaciar las escrituras pendientes antes de compactar el estado
+        write_q.put(None)
+        write_q.join()
+        entries, delta = [], Counter()
+        collect_writes(entries, unsaved_keys, delta)
+        if entries:
+            journal.write(b"\n".join(entries) + b"\n")
+        dirty = dirty or journal.tell() > 0  # Entradas de esta ejecución o de un journal sin compactar
+        journal.close()
+        checkpoint_domain_state(domain, domain_state, queue, inflight.values(), visited_log, unsaved_keys, dirty)
+        visited_log.close()
+        with lock:
+            if "domain_stats" not in global_state: global_state["domain_stats"] = {}
+            if domain not in global_state["domain_stats"]:
+                update_stats(global_state, domain, "bytes_processed", 0)
+            
+            fold_stats(global_state, domain, delta, 0.0, 0)
+            FILES_PROCESSED_THIS_RUN += delta["sitemaps_downloaded"]
+            global_state['domain_stats'][domain]['last_crawl'] = datetime.now().isoformat()
+            maybe_save_global_state(global_state)
+
+def run_site(site, global_state, lock):
+    """Envoltorio para el pool de dominios: respeta el límite de tiempo y aísla errores por sitio"""
+    if get_elapsed_time() > TIME_LIMIT_SECONDS or STOP_EVENT.is_set():
+        return
+    try:
+        process_site(site, global_state, lock)
+    except Exception as e:
+        logger.error(f"Failed to process site {site}: {e}", exc_info=True)
 
 def main():
     logger.info("Downloader Job Started")
     state = load_global_state()
+    lock = threading.Lock()
     
     def handler(sig, frame):
+        # Los dominios en curso terminan sus descargas en vuelo y compactan su journal en su
+        # finally, y el finally de main() hace el guardado final. Aquí se guarda ya por si llega
+        # un SIGKILL antes, pero sin esperar a `lock`: si lo tiene este mismo hilo (el finally de
+        # main()), esperar bloquearía el proceso; si lo tiene un dominio, basta el guardado final.
         logger.info("Termination signal received. Saving state...")
-        save_global_state(state)
-        sys.exit(0)
+        STOP_EVENT.set()
+        if lock.acquire(blocking=False):
+            try:
+                save_global_state(state)
+            finally:
+                lock.release()
         
     signal.signal(signal.SIGINT, handler)
     signal.signal(signal.SIGTERM, handler)
@@ -494,19 +1103,21 @@ def main():
         # Ordenar sitios por última fecha de rastreo
         normalized_sites.sort(key=lambda s: state.get('domain_stats', {}).get(s, {}).get('last_crawl') or '1970')
         
-        for site in normalized_sites:
-            if get_elapsed_time() > TIME_LIMIT_SECONDS:
-                logger.info("Time limit reached. Stopping crawler.")
-                break
-            try:
-                process_site(site, state)
-            except Exception as e:
-                logger.error(f"Failed to process site {site}: {e}", exc_info=True)
+        # Los dominios no comparten estado salvo `state`, protegido por `lock`
+        if normalized_sites:
+            with ThreadPoolExecutor(max_workers=min(len(normalized_sites), MAX_SITE_WORKERS)) as executor:
+                futures = [executor.submit(run_site, site, state, lock) for site in normalized_sites]
+                for future in as_completed(futures):
+                    future.result()
+        
+        if get_elapsed_time() > TIME_LIMIT_SECONDS:
+            logger.info("Time limit reached. Stopping crawler.")
                 
     except Exception as e:
         logger.critical(f"Global Crash: {e}", exc_info=True)
     finally:
-        save_global_state(state)
+        with lock:
+            save_global_state(state)
         logger.info("Job Complete")
 
 if __name__ == "__main__":
@@ -8,8 +8,14 @@ import json
 import time
 import logging
 import signal
+import functools
 from urllib.parse import unquote
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    import orjson
+except ImportError:  # Sin orjson se usa json de la stdlib
+    orjson = None
 
 # --- Configuración Pro ---
 DEFAULT_PHRASE = "Dragon Ball"
@@ -18,7 +24,8 @@ DATA_DIR = "sitemaps_data"
 SEARCH_STATE_FILE = os.path.join(DATA_DIR, "search_state.json")
 LOG_FILE = "searcher.log"
 
-MAX_WORKERS = 8  # Procesamiento paralelo para máxima velocidad
+MAX_WORKERS = os.cpu_count() or 4  # Un proceso por núcleo: el escaneo es CPU (regex + difflib) y el GIL frena a los hilos
+FILES_PER_TASK = 16  # Archivos por tarea: reparte el coste de enviar cada tarea al proceso
 FUZZY_THRESHOLD = 0.85
 TIME_LIMIT_SECONDS = 50 * 60 
 START_TIME = time.time()
@@ -32,25 +39,34 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Regex para extraer contenido relevante de sitemaps (namespaces incluidos)
-RE_CONTENT_BLOCKS = re.compile(r'<(loc|title|image:caption|image:title|news:title|video:title|video:description|video:tag)[^>]*>(.*?)</\1>', re.IGNORECASE | re.DOTALL)
+# Regex para extraer contenido relevante de sitemaps (namespaces incluidos).
+# Trabaja sobre bytes: solo se decodifica el texto de cada bloque, no el archivo entero
+RE_CONTENT_BLOCKS = re.compile(rb'<(loc|title|image:caption|image:title|news:title|video:title|video:description|video:tag)[^>]*>(.*?)</\1>', re.IGNORECASE | re.DOTALL)
+
+RE_NON_ALNUM = re.compile(r'[^a-z0-9]+')
 
 def slugify(text):
     """Normaliza texto para comparación de URLs y slugs."""
     if not text: return ""
     text = unquote(text).lower()
-    text = re.sub(r'[^a-z0-9]+', ' ', text).strip()
+    text = RE_NON_ALNUM.sub(' ', text).strip()
     return text
 
 def normalize_strict(text):
     """Normalización extrema para ignorar separadores."""
     return slugify(text).replace(' ', '')
 
+@functools.lru_cache(maxsize=8)
+def query_forms(query):
+    """Slug y forma colapsada de la frase: se calculan una vez, no por cada bloque"""
+    q_slug = slugify(query)
+    return q_slug, q_slug.replace(' ', '')
+
 def advanced_match(query, target):
     """
     Lógica de coincidencia multinivel de alto rendimiento.
     """
-    q_slug = slugify(query)
+    q_slug, q_strict = query_forms(query)
     t_slug = slugify(target)
     if not q_slug or not t_slug: return False, 0, None
 
@@ -59,14 +75,20 @@ def advanced_match(query, target):
         return True, 1.0, "Direct"
 
     # 2. Match de Términos Colapsados (ej: dragonball == dragon ball)
-    if normalize_strict(query) in normalize_strict(target):
+    # Equivale a normalize_strict() sobre ambos, reutilizando el slug ya calculado
+    if q_strict in t_slug.replace(' ', ''):
         return True, 0.95, "Collapsed"
 
     # 3. Match Difuso para variaciones menores
-    if len(t_slug) < (len(q_slug) * 5):
-        ratio = difflib.SequenceMatcher(None, q_slug, t_slug).ratio()
-        if ratio >= FUZZY_THRESHOLD:
-            return True, ratio, f"Fuzzy ({int(ratio*100)}%)"
+    # Las cotas baratas (longitudes, luego multiconjunto de letras) descartan casi todos los
+    # bloques antes del ratio() completo, que es lo caro; ninguna cota baja de ratio()
+    q_len, t_len = len(q_slug), len(t_slug)
+    if t_len < (q_len * 5) and 2.0 * min(q_len, t_len) / (q_len + t_len) >= FUZZY_THRESHOLD:
+        matcher = difflib.SequenceMatcher(None, q_slug, t_slug)
+        if matcher.quick_ratio() >= FUZZY_THRESHOLD:
+            ratio = matcher.ratio()
+            if ratio >= FUZZY_THRESHOLD:
+                return True, ratio, f"Fuzzy ({int(ratio*100)}%)"
 
     return False, 0, None
 
@@ -74,42 +96,64 @@ def process_single_file(path, phrase):
     """Procesa un solo archivo sitemap y devuelve los hallazgos."""
     results = []
     try:
-        with gzip.open(path, "rt", encoding="utf-8", errors="ignore") as f:
-            content = f.read()
-            blocks = RE_CONTENT_BLOCKS.findall(content)
+        with open(path, "rb") as f:
+            content = gzip.decompress(f.read())
+        blocks = RE_CONTENT_BLOCKS.findall(content)
+        
+        current_url = "N/A"
+        for tag, text in blocks:
+            tag = tag.decode('ascii')
+            text = text.decode('utf-8', 'ignore')
+            tag_clean = tag.lower()
+            if tag_clean == 'loc':
+                current_url = text.strip()
             
-            current_url = "N/A"
-            for tag, text in blocks:
-                tag_clean = tag.lower()
-                if tag_clean == 'loc':
-                    current_url = text.strip()
-                
-                is_hit, conf, m_type = advanced_match(phrase, text)
-                if is_hit:
-                    results.append({
-                        "url": current_url,
-                        "tag": tag,
-                        "text": text.strip(),
-                        "conf": conf,
-                        "type": m_type,
-                        "file": os.path.basename(path)
-                    })
+            is_hit, conf, m_type = advanced_match(phrase, text)
+            if is_hit:
+                results.append({
+                    "url": current_url,
+                    "tag": tag,
+                    "text": text.strip(),
+                    "conf": conf,
+                    "type": m_type,
+                    "file": os.path.basename(path)
+                })
         return path, results, True
     except Exception as e:
         return path, [], False
 
+def process_file_batch(paths, phrase):
+    """Unidad de trabajo de cada proceso: varios archivos por envío"""
+    return [process_single_file(path, phrase) for path in paths]
+
+def init_worker():
+    """Los procesos hijos no heredan el manejador de señales: guardar el estado es cosa del padre"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def json_dumps(data):
+    """Serializa a bytes compactos (orjson si está disponible)"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode()
+
+def json_loads(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
 def load_search_state():
     if os.path.exists(SEARCH_STATE_FILE):
         try:
-            with open(SEARCH_STATE_FILE, 'r') as f:
-                return json.load(f)
+            with open(SEARCH_STATE_FILE, 'rb') as f:
+                return json_loads(f.read())
         except: pass
     return {"phrase": SEARCH_PHRASE, "scanned_files": {}}
 
 def save_search_state(state):
     try:
-        with open(SEARCH_STATE_FILE + ".tmp", 'w') as f:
-            json.dump(state, f, indent=2)
+        with open(SEARCH_STATE_FILE + ".tmp", 'wb') as f:
+            f.write(json_dumps(state))
         os.replace(SEARCH_STATE_FILE + ".tmp", SEARCH_STATE_FILE)
     except Exception as e:
         logger.error(f"Error guardando estado: {e}")
@@ -148,22 +192,24 @@ def main():
     total_hits = []
     scanned_successfully = 0
 
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(process_single_file, path, SEARCH_PHRASE): path for path in all_files_to_scan}
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=init_worker) as executor:
+        batches = [all_files_to_scan[i:i + FILES_PER_TASK] for i in range(0, len(all_files_to_scan), FILES_PER_TASK)]
+        futures = [executor.submit(process_file_batch, batch, SEARCH_PHRASE) for batch in batches]
         for future in as_completed(futures):
-            path = futures[future]
             if time.time() - START_TIME > TIME_LIMIT_SECONDS:
                 logger.warning("Límite de tiempo alcanzado. Deteniendo procesamiento paralelo.")
+                # Sin esto el with esperaría a que terminasen todas las tareas pendientes
+                executor.shutdown(wait=False, cancel_futures=True)
                 break
                 
-            path, file_hits, success = future.result()
-            if success:
-                scanned_successfully += 1
-                total_hits.extend(file_hits)
-                state["scanned_files"][path] = os.path.getmtime(path)
-            
-            if scanned_successfully % 100 == 0:
-                logger.info(f"Progreso: {scanned_successfully}/{len(all_files_to_scan)} archivos...")
+            for path, file_hits, success in future.result():
+                if success:
+                    scanned_successfully += 1
+                    total_hits.extend(file_hits)
+                    state["scanned_files"][path] = os.path.getmtime(path)
+                
+                    if scanned_successfully % 100 == 0:
+                        logger.info(f"Progreso: {scanned_successfully}/{len(all_files_to_scan)} archivos...")
 
     if total_hits:
         # Deduplicación y ordenación por relevancia